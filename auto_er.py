@@ -10,9 +10,12 @@ overall process and provide parameters
 """
 
 import power_supply
+import storage
+import dashboard
 import time
 import datetime
 import csv
+import math
 import numpy as np
 
 
@@ -22,7 +25,9 @@ min_dx = 0.0  # Minimum dx, should always be step_magnitude
 max_first_div = 0.0  # X Value (Current)
 max_sec_div = 0.0  # X value (Current)
 max_sec_div_y = 0.0  # Y value (V/A^2)
+sweep_tripped = False  # Last sweep was cut short by power supply protection
 back_emf_at_time = 0.0
+charge_passed = 0.0  # Coulombs passed while refining so far this run
 
 
 # Refine at a specified current for a period, sampling current and voltage
@@ -40,23 +45,28 @@ def refine(
     zero_pad_data=True,
     max_refine_voltage=7.5,
     max_psu_voltage=12,
+    refine_ovp_voltage=None,
 ):
     # Add a row of zeroes to make integrating over the data easier (for total
     # charged passed, faradaic efficiency, etc.). We assume the charge
     # passed during non-refining is zero and thus can calculate it better.
     if zero_pad_data:
-        with open(csv_path, "a", newline="") as csvfile:
-            csv.writer(csvfile).writerow(
-                [
-                    datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "0.0",
-                    "0.0",
-                ]
-            )
+        storage.writerow(
+            csv_path,
+            [
+                datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "0.0",
+                "0.0",
+            ],
+            include_in_rollups=False,
+        )
 
     # Set the voltage of the power supply to a provided amount as a rudimentary
-    # way to prevent reduction of the salt (Lithium in our case)
-    psu.set_voltage(max_refine_voltage)
+    # way to prevent reduction of the salt (Lithium in our case). And have the
+    # power supply itself latch the output off if the voltage somehow goes
+    # past refine_ovp_voltage anyway, so sample_period only needs to be as
+    # short as the data needs rather than what safety needs
+    psu.set_limits(max_refine_voltage, refine_ovp_voltage)
 
     psu.enable()
 
@@ -64,20 +74,47 @@ def refine(
     psu.set_current(refining_current)
     high_r_state = False
 
+    # For integrating the measured current over time (trapezoidal rule)
+    global charge_passed
+    last_sample_time = None
+    last_current = 0.0
+
     # Until enough time has passed...
     while time.time() - start_time <= refining_period * 60:
         current, voltage = psu.measure()
 
+        sample_time = time.time()
+        if last_sample_time is not None:
+            charge_passed += (
+                (current + last_current) / 2 * (sample_time - last_sample_time)
+            )
+        last_sample_time = sample_time
+        last_current = current
+
         # Record the current and voltage to the csv
-        with open(csv_path, "a", newline="") as csvfile:
-            csv.writer(csvfile).writerow(
-                [
-                    datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    current,
-                    voltage,
-                ]
+        storage.writerow(
+            csv_path,
+            [
+                datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                current,
+                voltage,
+            ],
+        )
+
+        # If the power supply's own protection tripped, the output is already
+        # off. Treat it like a failed refining period
+        if psu.tripped():
+            print(
+                "\033[31m"  # Red
+                + "Refining stopped by power supply protection ("
+                + ", ".join(psu.tripped())
+                + ")"
+                + "\033[0m"  # Reset
             )
 
+            __end_refine__(psu, csv_path, zero_pad_data, max_psu_voltage)
+            return False
+
         calculated_resistance = 0
         try:
             calculated_resistance = voltage / current
@@ -97,19 +134,9 @@ def refine(
 
             # If it has had a high enough resistance for a long enough time
             if time.time() - high_r_start_time >= resistance_time:
-                psu.disable()  # Disable the power supply,
-                psu.set_voltage(max_psu_voltage)  # Set the max back
-                if zero_pad_data:  # Add a row of zeroes,
-                    with open(csv_path, "a", newline="") as csvfile:
-                        csv.writer(csvfile).writerow(
-                            [
-                                datetime.datetime.now().strftime(
-                                    "%Y-%m-%d %H:%M:%S"
-                                ),
-                                "0.0",
-                                "0.0",
-                            ]
-                        )
+                # Disable the power supply, set the max back and add a row of
+                # zeroes
+                __end_refine__(psu, csv_path, zero_pad_data, max_psu_voltage)
 
                 # Break, and return False
                 return False
@@ -134,20 +161,40 @@ def refine(
 
     # Add a row of zeroes indicating we are done refining
     if zero_pad_data:
-        with open(csv_path, "a", newline="") as csvfile:
-            csv.writer(csvfile).writerow(
-                [
-                    datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "0.0",
-                    "0.0",
-                ]
-            )
+        storage.writerow(
+            csv_path,
+            [
+                datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "0.0",
+                "0.0",
+            ],
+            include_in_rollups=False,
+        )
+
+    # Set the max voltage (and its protection) back to what it was before
+    psu.set_limits(max_psu_voltage, psu.ovp_voltage)
 
-    # Set the max voltage back to what it was before
-    psu.set_voltage(max_psu_voltage)
     return True
 
 
+# Ends a refining period early: disables the power supply, sets the max
+# voltage (and its protection) back and adds a row of zeroes
+def __end_refine__(psu, csv_path, zero_pad_data, max_psu_voltage):
+    psu.disable()
+    psu.set_limits(max_psu_voltage, psu.ovp_voltage)
+
+    if zero_pad_data:
+        storage.writerow(
+            csv_path,
+            [
+                datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "0.0",
+                "0.0",
+            ],
+            include_in_rollups=False,
+        )
+
+
 # Constantly records the voltage for a specified time to the csv, returning a
 # voltage after a specific amount of time has passed
 def back_emf(
@@ -188,6 +235,10 @@ def back_emf(
         csv.writer(csvfile).writerow(time_array)
         csv.writer(csvfile).writerow(voltage_array)
 
+    dashboard.set_back_emf(
+        time_array[1:], voltage_array[1:], volt_at_print_time
+    )
+
     # Return the voltage that's printed to the console
     return volt_at_print_time
 
@@ -203,11 +254,23 @@ def sweep(
     smoothed,
     starting_current=0.0,
     sweep_sample_amount=5,
+    adaptive=False,
+    target_stderr=0.001,
+    min_samples=3,
+    max_samples=30,
 ):
     current_step = starting_current
     psu.set_current(starting_current)
     current_array = []
     voltage_array = []
+    samples_array = []  # Number of samples averaged at each step
+    stderr_array = []  # Standard error of each step's mean voltage
+
+    # Without adaptive averaging, exactly sweep_sample_amount samples are
+    # taken at each step
+    if not adaptive:
+        min_samples = sweep_sample_amount
+        max_samples = sweep_sample_amount
 
     start_time = time.time()
     psu.enable()
@@ -218,18 +281,40 @@ def sweep(
 
         # By measuring right away, an entry is added to full_data.csv
         psu.measure()
+        if psu.tripped():
+            break
+
         time.sleep(step_duration)
 
-        total_current = 0
-        total_voltage = 0
-        for i in range(0, sweep_sample_amount):
+        # Keep a running mean and variance (Welford's method) and stop
+        # sampling as soon as the mean voltage is precise enough
+        n = 0
+        mean_current = 0.0
+        mean_voltage = 0.0
+        m2_voltage = 0.0  # Sum of squared differences from the mean voltage
+        stderr = float("nan")  # Undefined until there are two samples
+        while n < max_samples:
             c, v = psu.measure()
+            n += 1
+
+            mean_current += (c - mean_current) / n
+            delta = v - mean_voltage
+            mean_voltage += delta / n
+            m2_voltage += delta * (v - mean_voltage)
 
-            total_current += c
-            total_voltage += v
+            if n > 1:
+                stderr = math.sqrt(m2_voltage / (n - 1) / n)
 
-        current_array.append(total_current / sweep_sample_amount)
-        voltage_array.append(total_voltage / sweep_sample_amount)
+            if n >= min_samples and stderr <= target_stderr:
+                break
+
+        if psu.tripped():
+            break
+
+        current_array.append(mean_current)
+        voltage_array.append(mean_voltage)
+        samples_array.append(n)
+        stderr_array.append(stderr)
 
         # If we just recorded at the sweep_limit, break
         if current_step == sweep_limit:
@@ -244,43 +329,102 @@ def sweep(
         # starting_current of 0.0 and a sweep_limit of 60.0 and a
         # step_magnitude of 9, the current_step would eventually reach 54.0.
         # The next value *would* be 63, but the next line of code forces it
-        # down to 60 to ensure a measurement is made there.
-        if current_step > sweep_limit:
+        # down to 60 to ensure a measurement is made there. Landing just short
+        # of sweep_limit through floating point error counts as landing on it,
+        # instead of leaving a sliver of a last step
+        if current_step > sweep_limit - step_magnitude * 1e-6:
             current_step = sweep_limit
 
-    # Export the data to .csv first
-    with open(csv_path, "a", newline="") as csvfile:
-        # Add in the first column so each sweep appended to the .csv is:
-        # +-----------+-----------+-----------+-----------+----
-        # |  (blank)  | current_0 | current_1 | current_2 | ...
-        # +-----------+-----------+-----------+-----------+----
-        # | timestamp | voltage_0 | voltage_1 | voltage_2 | ...
-        # +-----------+-----------+-----------+-----------+----
-
-        current_row = [""]
-        voltage_row = [datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")]
-        for c in current_array:
-            current_row.append(str(c))
-
-        for v in voltage_array:
-            voltage_row.append(str(v))
+    global max_sec_div, max_sec_div_y, max_first_div, min_dx, sweep_tripped
+
+    # If the power supply's own protection latched the output off, the rest
+    # of the sweep was measured against nothing. It's neither recorded nor
+    # analyzed, and sweep_tripped tells main.py to ignore it
+    sweep_tripped = bool(psu.tripped())
+    if sweep_tripped:
+        print(
+            "\033[31m"  # Red
+            + "Sweep stopped by power supply protection ("
+            + ", ".join(psu.tripped())
+            + ")"
+            + "\033[0m"  # Reset
+        )
+        max_sec_div, max_sec_div_y, max_first_div, min_dx = 0.0, 0.0, 0.0, 0.0
+        return max_sec_div
+
+    # Export the data to .csv first. Each sweep appended to the .csv is:
+    # +-----------+-----------+-----------+-----------+----
+    # |  (blank)  | current_0 | current_1 | current_2 | ...
+    # +-----------+-----------+-----------+-----------+----
+    # | timestamp | voltage_0 | voltage_1 | voltage_2 | ...
+    # +-----------+-----------+-----------+-----------+----
+    # |  samples  | samples_0 | samples_1 | samples_2 | ...
+    # +-----------+-----------+-----------+-----------+----
+    # |  stderr   | stderr_0  | stderr_1  | stderr_2  | ...
+    # +-----------+-----------+-----------+-----------+----
+    # Where samples is how many samples were averaged at each step and stderr
+    # is the standard error of the mean voltage, for weighting each point
+    current_row = [""]
+    voltage_row = [datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")]
+    samples_row = ["samples"]
+    stderr_row = ["stderr"]
+    for c in current_array:
+        current_row.append(str(c))
+
+    for v in voltage_array:
+        voltage_row.append(str(v))
+
+    for n in samples_array:
+        samples_row.append(str(n))
+
+    for e in stderr_array:
+        stderr_row.append(str(e))
 
+    with open(csv_path, "a", newline="") as csvfile:
         csv.writer(csvfile).writerow(current_row)
         csv.writer(csvfile).writerow(voltage_row)
+        csv.writer(csvfile).writerow(samples_row)
+        csv.writer(csvfile).writerow(stderr_row)
 
     # Now with a current and voltage array, find the maximum second derivative
+    max_sec_div, max_sec_div_y, max_first_div, min_dx = analyze_sweep(
+        current_array, voltage_array, smoothed
+    )
 
-    # Ignore any divide by zero errors, as they are handled below
-    with np.errstate(divide="ignore", invalid="ignore"):
-        # First differentiate voltage w.r.t. current
-        dE_dI = np.where(
-            # Any zeros in the denominator will now result in the quotient
-            # being zero
-            np.diff(current_array) == 0,  # If entry is zero
-            0,  # Set to zero
-            np.diff(voltage_array)
-            / np.diff(current_array),  # Otherwise divide
-        )
+    dashboard.set_sweep(current_array, voltage_array, max_sec_div)
+
+    # Current corresponding to the index of the maximum second derivative
+    return max_sec_div
+
+
+# Returns an estimate, in seconds, of how long sweep() will take with the given
+# parameters. sample_latency is how long one measure() takes
+def sweep_time_estimate(
+    step_duration,
+    step_magnitude,
+    sweep_limit,
+    starting_current=0.0,
+    sweep_sample_amount=5,
+    sample_latency=0.65,
+):
+    # time_estimate = steps * step duration
+    # steps = 1 + ceil(current range / step magnitude)
+    current_range = sweep_limit - starting_current
+    num_steps = 1 + math.ceil(current_range / step_magnitude)
+    time_estimate = num_steps * step_duration
+
+    # Add time for measurement to help with the time_estimate's accuracy
+    time_estimate += num_steps * sweep_sample_amount * sample_latency
+
+    return time_estimate
+
+
+# Given the averaged current and voltage arrays of a sweep, returns a tuple of
+# (max_sec_div, max_sec_div_y, max_first_div, min_dx). This is the numerical
+# part of sweep(), kept separate so it can be benchmarked without a power
+# supply (see benchmarks/bench_analysis.py)
+def analyze_sweep(current_array, voltage_array, smoothed):
+    dE_dI = __first_div__(current_array, voltage_array)
 
     if smoothed:
         smoothed_sec_div = __sg_sec_div_smoothed__(
@@ -291,15 +435,7 @@ def sweep(
         max_sec_div = float(current_array[np.argmax(smoothed_sec_div)])
 
     else:
-        # Ignore any divide by zero errors, as they are handled below
-        with np.errstate(divide="ignore", invalid="ignore"):
-
-            # Then differentiate that w.r.t. current (w/ size n-1)
-            d2E_dI2 = np.where(
-                np.diff(current_array)[:-1] == 0,
-                0,
-                np.diff(dE_dI) / np.diff(current_array)[:-1],
-            )
+        d2E_dI2 = __sec_div__(current_array, dE_dI)
 
         max_sec_div_y = float(np.max(d2E_dI2))
         max_sec_div = float(current_array[np.argmax(d2E_dI2)])
@@ -307,8 +443,35 @@ def sweep(
     max_first_div = float(np.max(dE_dI))
     min_dx = float(np.min(np.diff(current_array)))
 
-    # Current corresponding to the index of the maximum second derivative
-    return max_sec_div
+    return max_sec_div, max_sec_div_y, max_first_div, min_dx
+
+
+# Given two arrays of equal length, x and y, returns the first derivative of y
+# w.r.t. x (w/ size n-1). Any zero dx results in a zero derivative
+def __first_div__(x, y):
+    # Ignore any divide by zero errors, as they are handled below
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # First differentiate voltage w.r.t. current
+        return np.where(
+            # Any zeros in the denominator will now result in the quotient
+            # being zero
+            np.diff(x) == 0,  # If entry is zero
+            0,  # Set to zero
+            np.diff(y) / np.diff(x),  # Otherwise divide
+        )
+
+
+# Given x and the first derivative from __first_div__(), returns the second
+# derivative (w/ size n-2). Any zero dx results in a zero derivative
+def __sec_div__(x, dy_dx):
+    # Ignore any divide by zero errors, as they are handled below
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Then differentiate that w.r.t. current
+        return np.where(
+            np.diff(x)[:-1] == 0,
+            0,
+            np.diff(dy_dx) / np.diff(x)[:-1],
+        )
 
 
 # Given two arrays of equal length, x and y, returns a second derivative of the
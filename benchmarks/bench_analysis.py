@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" bench_analysis.py
+
+Micro-benchmarks for the numerical part of auto_er.sweep(): the first and
+second derivatives, the Savitzky-Golay smoothed second derivative and the
+max_sec_div/min_dx extraction in auto_er.analyze_sweep(). Each path is timed
+across sweep sizes and batch counts (sweeps analyzed back to back) and the
+results are compared against baseline.json, which has to be recorded on the
+same computer (it isn't kept in the repository). The script exits with 1 if
+any case is slower, or allocates more, than the baseline by more than the
+threshold percentage, both on the first run and when re-timed.
+
+Usage, from the top level directory:
+
+    $ python ./benchmarks/bench_analysis.py            # compare to baseline
+    $ python ./benchmarks/bench_analysis.py --save     # record a new baseline
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import auto_er  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+SIZES = [10, 100, 1000, 10000, 100000]
+BATCHES = [1, 10, 100]
+
+# Cases with more points than this in a batch are skipped so a full run stays
+# around a minute (the smoothed second derivative is not linear in n)
+MAX_BATCH_POINTS = 100000
+
+# Allocation growth below this many bytes is noise, not a regression
+ALLOCATION_SLACK = 4096
+
+# Each timed sample loops over the batch until it takes at least this long,
+# so the timer's resolution and one-off interruptions don't dominate it
+MIN_SAMPLE_SECONDS = 0.02
+
+# Cases whose batch takes less than this are reported but not gated on, as
+# they are too short to time reliably
+MIN_GATED_SECONDS = 50e-6
+
+
+# Each path takes one sweep (current list, voltage list) and analyzes it the
+# same way sweep() does
+PATHS = {
+    "first_div": lambda c, v: auto_er.__first_div__(c, v),
+    "sec_div": lambda c, v: auto_er.__sec_div__(
+        c, auto_er.__first_div__(c, v)
+    ),
+    "sg_sec_div_smoothed": lambda c, v: auto_er.__sg_sec_div_smoothed__(c, v),
+    "analyze_sweep": lambda c, v: auto_er.analyze_sweep(c, v, False),
+    "analyze_sweep_smoothed": lambda c, v: auto_er.analyze_sweep(c, v, True),
+}
+
+
+# Returns a batch of synthetic sweeps shaped like a real one: linear up to a
+# knee, then curving upwards, with a little noise. Plain lists, like sweep()
+def make_sweeps(size, batch, seed=0):
+    rng = np.random.default_rng(seed)
+    sweeps = []
+
+    for _ in range(batch):
+        current = np.linspace(0.0, 60.0, size)
+        knee = rng.uniform(20.0, 45.0)
+        voltage = (
+            0.5
+            + 0.05 * current
+            + 0.002 * np.clip(current - knee, 0, None) ** 2
+            + rng.normal(0, 0.002, size)
+        )
+        sweeps.append((list(current), list(voltage)))
+
+    return sweeps
+
+
+# Returns how long, in seconds, it took to analyze the whole batch loops times
+def time_loops(path, sweeps, loops):
+    start = time.perf_counter()
+
+    for _ in range(loops):
+        for current, voltage in sweeps:
+            path(current, voltage)
+
+    return time.perf_counter() - start
+
+
+# Returns the best time, in seconds, to analyze the whole batch once. At least
+# min_repeats samples are taken, and more until min_time has passed. Anything
+# else running on the computer only ever makes a sample slower, so the fastest
+# one is the steadiest from run to run (much more so than the median)
+def time_batch(path, sweeps, min_time, min_repeats):
+    # Find how many loops make a sample long enough to time reliably
+    loops = 1
+    while time_loops(path, sweeps, loops) < MIN_SAMPLE_SECONDS:
+        loops *= 2
+
+    samples = []
+    start = time.perf_counter()
+
+    while len(samples) < min_repeats or time.perf_counter() - start < min_time:
+        samples.append(time_loops(path, sweeps, loops) / loops)
+
+    return min(samples)
+
+
+# Returns the peak number of bytes allocated while analyzing the whole batch
+def peak_allocation(path, sweeps):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline, _ = tracemalloc.get_traced_memory()
+
+    for current, voltage in sweeps:
+        path(current, voltage)
+
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return peak - baseline
+
+
+# Times every case, or only the cases named in only
+def run(sizes, batches, min_time, min_repeats, only=None):
+    cases = {}
+
+    for name, path in PATHS.items():
+        for size in sizes:
+            for batch in batches:
+                key = name + "/n=" + str(size) + "/batch=" + str(batch)
+                if size * batch > MAX_BATCH_POINTS or (
+                    only is not None and key not in only
+                ):
+                    continue
+
+                sweeps = make_sweeps(size, batch)
+                seconds = time_batch(path, sweeps, min_time, min_repeats)
+
+                cases[key] = {
+                    "seconds": seconds,
+                    "points_per_s": size * batch / seconds,
+                    "peak_bytes": peak_allocation(path, sweeps),
+                }
+
+                print(
+                    "{:<44}{:>14.0f} pts/s{:>14d} B".format(
+                        key,
+                        cases[key]["points_per_s"],
+                        cases[key]["peak_bytes"],
+                    )
+                )
+
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "node": platform.node(),
+        "cases": cases,
+    }
+
+
+# Returns {case: [human readable regressions]} of results vs. baseline
+def compare(results, baseline, threshold):
+    regressions = {}
+
+    for key, base in baseline["cases"].items():
+        if key not in results["cases"]:
+            continue
+
+        new = results["cases"][key]
+
+        slowdown = (
+            (base["points_per_s"] - new["points_per_s"])
+            / base["points_per_s"]
+            * 100
+        )
+        if slowdown > threshold and base["seconds"] >= MIN_GATED_SECONDS:
+            regressions.setdefault(key, []).append(
+                key + ": throughput down " + str(round(slowdown, 1)) + "%"
+            )
+
+        growth = new["peak_bytes"] - base["peak_bytes"]
+        if (
+            growth > ALLOCATION_SLACK
+            and growth / max(base["peak_bytes"], 1) * 100 > threshold
+        ):
+            regressions.setdefault(key, []).append(
+                key
+                + ": peak allocation up from "
+                + str(base["peak_bytes"])
+                + " B to "
+                + str(new["peak_bytes"])
+                + " B"
+            )
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=SIZES, help="sweep sizes"
+    )
+    parser.add_argument(
+        "--batches", type=int, nargs="+", default=BATCHES, help="batch counts"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=25.0,
+        help="allowed regression, in percent (default 25)",
+    )
+    parser.add_argument(
+        "--min-time",
+        type=float,
+        default=0.5,
+        help="seconds to spend timing each case (default 0.5)",
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=7,
+        help="minimum number of timed samples per case (default 7)",
+    )
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument(
+        "--save",
+        action="store_true",
+        help="record the results as the new baseline instead of comparing",
+    )
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.batches, args.min_time, args.repeats)
+
+    if args.save:
+        with open(args.baseline, "w") as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+            file.write("\n")
+
+        print("Baseline saved to " + args.baseline)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline at " + args.baseline + ", run with --save first")
+        return 1
+
+    with open(args.baseline, "r") as file:
+        baseline = json.load(file)
+
+    # Timings from another computer (or Python/numpy) say nothing about this
+    # code, so they aren't used as a pass/fail reference
+    for field in ["node", "machine", "python", "numpy"]:
+        if baseline.get(field) != results[field]:
+            print(
+                "The baseline was recorded with "
+                + field
+                + " "
+                + str(baseline.get(field))
+                + ", not "
+                + str(results[field])
+                + ". Run with --save to record one here first"
+            )
+            return 1
+
+    regressions = compare(results, baseline, args.threshold)
+
+    # A slow first run can be a busy computer, so the slower cases are timed
+    # again and only count if the faster of the two timings still regressed
+    if regressions:
+        print("Re-timing " + str(len(regressions)) + " slower cases")
+        rerun = run(
+            args.sizes,
+            args.batches,
+            args.min_time,
+            args.repeats,
+            only=set(regressions),
+        )
+        for key, case in rerun["cases"].items():
+            if case["points_per_s"] > results["cases"][key]["points_per_s"]:
+                results["cases"][key] = case
+
+        regressions = compare(results, baseline, args.threshold)
+
+    if regressions:
+        print("\033[31m" + "REGRESSIONS:" + "\033[0m")  # Red
+        for case in regressions.values():
+            for regression in case:
+                print("\t" + regression)
+        return 1
+
+    print(
+        "\033[32m"  # Green
+        + "No regressions beyond "
+        + str(args.threshold)
+        + "%"
+        + "\033[0m"  # Reset
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
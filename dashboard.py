@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" dashboard.py
+
+This module contains a small local web dashboard for watching a run. Recent
+samples are kept in memory in a bounded ring buffer along with the latest
+sweep and back emf results, and browsers are sent incremental updates over
+Server-Sent Events. Nothing is ever read back from the .csv files.
+
+"""
+
+import collections
+import http.server
+import itertools
+import json
+import threading
+import time
+import urllib.parse
+
+# Guards everything below. Waiting clients are woken up whenever it changes
+_condition = threading.Condition()
+
+# (sequence number, seconds since epoch, current, voltage) of recent samples
+_samples = collections.deque(maxlen=100000)
+_sample_seq = 0
+
+# Latest results, each with a version so clients only resend what changed
+_sweep = {"version": 0}
+_back_emf = {"version": 0}
+_status = {"version": 0, "text": "", "eta": None}
+
+_server = None
+
+
+# Starts the dashboard on a background thread. Until this is called, the
+# functions that publish data return straight away
+def start(host="127.0.0.1", port=8080, buffer_size=100000):
+    global _server, _samples
+
+    if _server is not None:
+        return
+
+    with _condition:
+        _samples = collections.deque(_samples, maxlen=buffer_size)
+
+    # The dashboard is only for watching, so a port that's already taken (ex.
+    # by another run) mustn't stop the run itself
+    try:
+        _server = http.server.ThreadingHTTPServer((host, port), _Handler)
+
+    except OSError as error:
+        print(
+            "\033[31m"  # Red
+            + "Dashboard not started, could not listen on "
+            + host
+            + ":"
+            + str(port)
+            + ":\t"
+            + str(error)
+            + "\033[0m"  # Reset
+        )
+        return
+
+    _server.daemon_threads = True
+    threading.Thread(
+        target=_server.serve_forever, name="dashboard", daemon=True
+    ).start()
+
+    print("\tDashboard:\thttp://" + host + ":" + str(port) + "/")
+
+
+def stop():
+    global _server
+
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
+
+
+# Called for every measurement. Only appends to the ring buffer, so it never
+# waits on a client
+def add_sample(timestamp, current, voltage):
+    global _sample_seq
+
+    if _server is None:
+        return
+
+    with _condition:
+        _sample_seq += 1
+        _samples.append((_sample_seq, timestamp, current, voltage))
+        _condition.notify_all()
+
+
+# Called once a sweep has been analyzed
+def set_sweep(current_array, voltage_array, max_sec_div):
+    _publish(
+        _sweep,
+        time=time.time(),
+        current=[float(c) for c in current_array],
+        voltage=[float(v) for v in voltage_array],
+        max_sec_div=max_sec_div,
+    )
+
+
+# Called once a back emf period has finished
+def set_back_emf(time_array, voltage_array, back_emf_at_time):
+    _publish(
+        _back_emf,
+        time=time.time(),
+        seconds=[float(t) for t in time_array],
+        voltage=[float(v) for v in voltage_array],
+        back_emf_at_time=back_emf_at_time,
+    )
+
+
+# Called by main.py whenever a new part of the procedure starts, with the
+# expected completion time in seconds since epoch
+def set_status(text, eta=None):
+    _publish(_status, text=text, eta=eta)
+
+
+def _publish(result, **fields):
+    if _server is None:
+        return
+
+    with _condition:
+        result.update(fields)
+        result["version"] += 1
+        _condition.notify_all()
+
+
+# Returns the samples newer than after_seq, oldest first. Only a single copy
+# of the newest ones is made while holding the lock, so add_sample() isn't
+# kept waiting by a client connecting
+def _samples_since(after_seq):
+    with _condition:
+        count = min(_sample_seq - after_seq, len(_samples))
+        samples = list(itertools.islice(reversed(_samples), count))
+        last_seq = _sample_seq
+
+    samples.reverse()
+    return samples, last_seq
+
+
+# Downsamples samples into at most the given number of equal-width time
+# buckets, keeping the mean current and the min/mean/max voltage of each
+def downsample(samples, points):
+    result = {
+        "t": [],
+        "current": [],
+        "voltage": [],
+        "voltage_min": [],
+        "voltage_max": [],
+    }
+
+    if not samples:
+        return result
+
+    start = samples[0][1]
+    width = (samples[-1][1] - start) / points if points > 0 else 0
+
+    bucket = None
+    for _, timestamp, current, voltage in samples:
+        index = bucket
+        if width > 0:
+            index = min(int((timestamp - start) / width), points - 1)
+
+        if index != bucket or bucket is None:
+            if bucket is not None:
+                result["current"][-1] /= count
+                result["voltage"][-1] /= count
+
+            bucket = index
+            count = 0
+            result["t"].append(timestamp)
+            result["current"].append(0.0)
+            result["voltage"].append(0.0)
+            result["voltage_min"].append(voltage)
+            result["voltage_max"].append(voltage)
+
+        count += 1
+        result["current"][-1] += current
+        result["voltage"][-1] += voltage
+        result["voltage_min"][-1] = min(result["voltage_min"][-1], voltage)
+        result["voltage_max"][-1] = max(result["voltage_max"][-1], voltage)
+
+    result["current"][-1] /= count
+    result["voltage"][-1] /= count
+
+    return result
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # Seconds between keep-alive comments on an idle event stream
+    keep_alive = 15
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+
+        # Window (seconds) of history and how many points to squeeze it into
+        try:
+            window = float(query.get("window", ["600"])[0])
+            points = int(query.get("points", ["600"])[0])
+            if not window > 0 or points <= 0:
+                raise ValueError
+
+        except ValueError:
+            self.__send(
+                400,
+                "text/plain",
+                b"window and points must be positive numbers",
+            )
+            return
+
+        if url.path == "/":
+            self.__send(200, "text/html; charset=utf-8", _PAGE.encode())
+
+        elif url.path == "/state":
+            body = json.dumps(self.__snapshot(window, points)[0]).encode()
+            self.__send(200, "application/json", body)
+
+        elif url.path == "/events":
+            self.__stream(window, points)
+
+        else:
+            self.__send(404, "text/plain", b"Not found")
+
+    # Keep the console for the run itself
+    def log_message(self, format, *args):
+        pass
+
+    def __send(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Returns everything currently known along with the sequence number of
+    # the newest sample in it. Downsampling happens after the lock is released
+    def __snapshot(self, window, points):
+        samples, last_seq = _samples_since(0)
+        if samples:
+            samples = [s for s in samples if s[1] >= samples[-1][1] - window]
+
+        with _condition:
+            snapshot = {
+                "sweep": dict(_sweep),
+                "back_emf": dict(_back_emf),
+                "status": dict(_status),
+            }
+
+        snapshot["samples"] = downsample(samples, points)
+        return snapshot, last_seq
+
+    # Sends the downsampled history first, then only what has changed since,
+    # until the browser goes away
+    def __stream(self, window, points):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        sent = {"sweep": 0, "back_emf": 0, "status": 0}
+        snapshot, last_seq = self.__snapshot(window, points)
+
+        try:
+            self.__event("samples", snapshot["samples"])
+
+            while True:
+                for name, result in [
+                    ("sweep", _sweep),
+                    ("back_emf", _back_emf),
+                    ("status", _status),
+                ]:
+                    with _condition:
+                        version = result["version"]
+                        data = dict(result) if version != sent[name] else None
+
+                    if data is not None and version > 0:
+                        self.__event(name, data)
+                    sent[name] = version
+
+                samples, last_seq = _samples_since(last_seq)
+                if samples:
+                    self.__event("samples", downsample(samples, points))
+
+                with _condition:
+                    if _sample_seq == last_seq and all(
+                        result["version"] == sent[name]
+                        for name, result in [
+                            ("sweep", _sweep),
+                            ("back_emf", _back_emf),
+                            ("status", _status),
+                        ]
+                    ):
+                        if not _condition.wait(self.keep_alive):
+                            self.wfile.write(b": keep-alive\n\n")
+                            self.wfile.flush()
+
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def __event(self, name, data):
+        message = "event: " + name + "\ndata: " + json.dumps(data) + "\n\n"
+        self.wfile.write(message.encode())
+        self.wfile.flush()
+
+
+# The page served at "/". Plots are drawn straight onto canvases so nothing
+# needs to be fetched from the internet
+_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Autonomous Electrorefining</title>
+<style>
+  body { font-family: sans-serif; margin: 1em; background: #fafafa; }
+  h1 { font-size: 1.2em; }
+  #status { font-weight: bold; }
+  canvas { background: white; border: 1px solid #ccc; margin: 0.5em 0; }
+  .plots { display: flex; flex-wrap: wrap; gap: 1em; }
+</style>
+</head>
+<body>
+<h1>Autonomous Electrorefining</h1>
+<div id="status">Waiting for data...</div>
+<div id="latest"></div>
+<div class="plots">
+  <div><div>Voltage (V) and current (A)</div>
+    <canvas id="samples" width="900" height="300"></canvas></div>
+  <div><div>Latest sweep: voltage (V) vs current (A)</div>
+    <canvas id="sweep" width="440" height="300"></canvas></div>
+  <div><div>Latest back emf: voltage (V) vs time (s)</div>
+    <canvas id="back_emf" width="440" height="300"></canvas></div>
+</div>
+<script>
+const MAX_POINTS = 5000;
+const samples = {t: [], current: [], voltage: [], voltage_min: [],
+                 voltage_max: []};
+
+function plot(id, series, marker) {
+  const canvas = document.getElementById(id);
+  const ctx = canvas.getContext("2d");
+  ctx.clearRect(0, 0, canvas.width, canvas.height);
+  const xs = series.flatMap(s => s.x), ys = series.flatMap(s => s.y);
+  if (xs.length === 0) return;
+  const xmin = Math.min(...xs), xmax = Math.max(...xs);
+  const ymin = Math.min(...ys), ymax = Math.max(...ys);
+  const sx = x => 40 + (x - xmin) / ((xmax - xmin) || 1) * (canvas.width - 50);
+  const sy = y => canvas.height - 20 -
+    (y - ymin) / ((ymax - ymin) || 1) * (canvas.height - 30);
+  ctx.fillStyle = "#444";
+  ctx.fillText(ymax.toPrecision(4), 2, 12);
+  ctx.fillText(ymin.toPrecision(4), 2, canvas.height - 22);
+  for (const s of series) {
+    ctx.strokeStyle = s.color;
+    ctx.beginPath();
+    s.x.forEach((x, i) => i ? ctx.lineTo(sx(x), sy(s.y[i]))
+                            : ctx.moveTo(sx(x), sy(s.y[i])));
+    ctx.stroke();
+  }
+  if (marker !== undefined && marker !== null) {
+    ctx.strokeStyle = "red";
+    ctx.beginPath();
+    ctx.moveTo(sx(marker), 10);
+    ctx.lineTo(sx(marker), canvas.height - 20);
+    ctx.stroke();
+  }
+}
+
+function drawSamples() {
+  plot("samples", [
+    {x: samples.t, y: samples.voltage_max, color: "#bbd"},
+    {x: samples.t, y: samples.voltage_min, color: "#bbd"},
+    {x: samples.t, y: samples.voltage, color: "blue"},
+    {x: samples.t, y: samples.current, color: "green"},
+  ]);
+  const n = samples.t.length - 1;
+  if (n >= 0) {
+    document.getElementById("latest").textContent =
+      new Date(samples.t[n] * 1000).toLocaleTimeString() + "  " +
+      samples.current[n].toFixed(3) + " A  " +
+      samples.voltage[n].toFixed(3) + " V";
+  }
+}
+
+const events = new EventSource("/events" + location.search);
+events.addEventListener("samples", e => {
+  const d = JSON.parse(e.data);
+  for (const k in samples) {
+    samples[k].push(...d[k]);
+    samples[k].splice(0, Math.max(0, samples[k].length - MAX_POINTS));
+  }
+  drawSamples();
+});
+events.addEventListener("sweep", e => {
+  const d = JSON.parse(e.data);
+  plot("sweep", [{x: d.current, y: d.voltage, color: "blue"}], d.max_sec_div);
+});
+events.addEventListener("back_emf", e => {
+  const d = JSON.parse(e.data);
+  plot("back_emf", [{x: d.seconds, y: d.voltage, color: "blue"}]);
+});
+events.addEventListener("status", e => {
+  const d = JSON.parse(e.data);
+  document.getElementById("status").textContent = d.text + (d.eta ?
+    "  (ETA " + new Date(d.eta * 1000).toLocaleTimeString() + ")" : "");
+});
+</script>
+</body>
+</html>
+"""
@@ -15,30 +15,50 @@ in the same directory.
 
 import power_supply
 import auto_er
+import storage
+import dashboard
+import shm_ring
+import sweep_history
+import procedure
 import yaml
 import sys
 import datetime as dt
 import math
-import time
 
 YAML_FILE = "prefs.yaml"
 
 
-# Create your own loop inside this function.
-# Useful functions:
+# The procedure itself is written in the YAML file at p.refs["procedure_path"]
+# (procedure.yaml by default) and run by procedure.py. Steps available there:
 #
-#   refine(current) or refine(current, time)
+#   refine: {current: X} or refine: {current: X, time: X}
 #
-#   sweep() or sweep(magnitude, time)
+#   sweep: {} or sweep: {magnitude: X, time: X}
 #
-#   back_emf() or back_emf(print_time, time)
+#   back_emf: {} or back_emf: {print_time: X, time: X}
 #
-# Useful variables:
+#   wait: X or wait: {seconds: X, message: "..."}
 #
-#   auto_er.refine_succeeded:
+#   set: {name: value}, for: {name, values, steps}, while: {condition, steps}
+#   and if: {condition, then, else}
+#
+# Conditions available there (optionally starting with "not "):
+#
+#   refine_succeeded:
 #       Whether or not the last refining period stopped early due to high
 #       resistance
 #
+#   sweep_valid, sweep_linear:
+#       See the functions below
+#
+# Values available there, besides numbers and names given to set/for:
+#
+#   sweep_current:
+#       auto_er.max_sec_div * operating_percentage + operating_offset, i.e.
+#       the refining current suggested by the last sweep
+#
+# Useful variables when adding more of these:
+#
 #   auto_er.back_emf_at_time:
 #       Voltage of the last back emf period at the given print_time (ex 45s)
 #
@@ -46,6 +66,9 @@ YAML_FILE = "prefs.yaml"
 #       Current where the highest second derivative of voltage w.r.t. current
 #       occurs
 #
+#   auto_er.charge_passed:
+#       Coulombs passed while refining so far this run
+#
 #   p.refs["parameter"]:
 #       Contains the specifed parameter from prefs.yaml (quotes needed)
 
@@ -53,83 +76,32 @@ YAML_FILE = "prefs.yaml"
 def main():
     setup()  # Needed when starting the program
 
-    sweep()
-
-    starting_currents = [10, 15, 20]
-
-    for current in starting_currents:
-        refine(current=current, time=60)
-
-        # Normal sweep
-        print("Sweeping in 30s...")
-        time.sleep(30)
-        sweep(magnitude=1.5, time=30)
-
-        # 30s sweep
-        refine(current=current, time=2)
-        print("Sweeping in 30s...")
-        time.sleep(30)
-        sweep(magnitude=1.5, time=10)
-
-        # 1s sweep
-        refine(current=current, time=2)
-        print("Sweeping in 30s...")
-        time.sleep(30)
-        sweep(magnitude=1.5, time=1)
-
-        # Instant sweep
-        refine(current=current, time=2)
-        print("Sweeping in 30s...")
-        time.sleep(30)
-        sweep(magnitude=1.5, time=0)
-
-        refine(current=current, time=2)
-        back_emf()
-
-    # Calculate the first refining_current
-    refining_current = 0.0
-
-    if sweep_valid() and not sweep_linear():
-        refining_current = (
-            auto_er.max_sec_div * p.refs["operating_percantage"]
-            + p.refs["operating_offset"]
-        )
-
-    elif sweep_valid() and sweep_linear():
-        refining_current = 20
-
-    elif not sweep_valid():
-        refining_current = 20
-
-    # Main loop! Will break once a refining period fails (R too high)
-    while auto_er.refine_succeeded:
-        refine(current=refining_current)
-
-        print("Sweeping in 30s...")
-        time.sleep(30)
-        sweep()
-
-        refine(current=refining_current, time=2)
-
-        back_emf()
-
-        # Calculate next refining_current if the sweep was valid
-        if sweep_valid():
-            if sweep_linear():
-                refining_current = refining_current * 0.75
-
-            else:
-                refining_current = (
-                    auto_er.max_sec_div * p.refs["operating_percantage"]
-                    + p.refs["operating_offset"]
-                )
-
-        else:
-            refining_current = refining_current * 0.75
+    procedure.Procedure(
+        p.refs["procedure_path"],
+        actions={"refine": refine, "sweep": sweep, "back_emf": back_emf},
+        conditions={
+            "refine_succeeded": lambda: auto_er.refine_succeeded,
+            "sweep_valid": sweep_valid,
+            "sweep_linear": sweep_linear,
+        },
+        values={"sweep_current": sweep_current},
+        prefs=p.refs,
+    ).run()
+
+
+# The refining current suggested by the last sweep
+def sweep_current():
+    return (
+        auto_er.max_sec_div * p.refs["operating_percentage"]
+        + p.refs["operating_offset"]
+    )
 
 
 def sweep_valid():
-    if auto_er.min_dx < 0:
+    if auto_er.sweep_tripped:
+        return False
+
+    elif auto_er.min_dx < 0:
         return False
 
     elif auto_er.max_sec_div > auto_er.max_first_div:
@@ -179,6 +151,39 @@ p()
 def setup():
     p()  # Create p.refs
 
+    # Rotate, compress and roll up the files that grow for the whole run
+    if p.refs["archive_data"]:
+        for path in [p.refs["data_csv_path"], p.refs["full_data_path"]]:
+            storage.open_archive(
+                path,
+                max_bytes=p.refs["archive_max_bytes"],
+                max_age=p.refs["archive_max_age"],
+                compression=p.refs["archive_compression"],
+                rollups=p.refs["archive_rollups"],
+            )
+
+    # Serve the live dashboard before anything is measured
+    if p.refs["dashboard_enabled"]:
+        dashboard.start(
+            host=p.refs["dashboard_host"],
+            port=p.refs["dashboard_port"],
+            buffer_size=p.refs["dashboard_buffer"],
+        )
+
+    # Publish samples to shared memory for other processes to read
+    if p.refs["shm_ring_enabled"]:
+        shm_ring.start(
+            name=p.refs["shm_ring_name"],
+            capacity=p.refs["shm_ring_capacity"],
+        )
+
+    # Where the knee was found in this run's sweeps, for narrowing new ones
+    setup.sweep_history = sweep_history.Sweep_history(
+        csv_path=p.refs["sweep_history_path"],
+        fit_points=p.refs["sweep_history_points"],
+        min_half_width=p.refs["sweep_window_min"],
+    )
+
     setup.psu = power_supply.Power_supply(
         ip=p.refs["psu_address"],
         port=p.refs["psu_port"],
@@ -186,6 +191,8 @@ def setup():
         buffer=p.refs["psu_buffer"],
         max_psu_voltage=p.refs["max_psu_voltage"],
         full_csv_path=p.refs["full_data_path"],
+        ovp_voltage=p.refs["psu_ovp_voltage"],
+        ocp=p.refs["psu_ocp"],
     )
 
 
@@ -213,6 +220,10 @@ def refine(current, time=p.refs["refining_period"]):
 
     # "ETA: [X]"
     print("\tETA:\t" + completion_time.strftime("%I:%M:%S %p"))
+    dashboard.set_status(
+        "Refining at " + str(round(current, 2)) + "A",
+        completion_time.timestamp(),
+    )
 
     refine_status = auto_er.refine(
         psu=setup.psu,
@@ -225,6 +236,7 @@ def refine(current, time=p.refs["refining_period"]):
         zero_pad_data=p.refs["zero_pad_data"],
         max_refine_voltage=p.refs["max_refine_voltage"],
         max_psu_voltage=p.refs["max_psu_voltage"],
+        refine_ovp_voltage=p.refs["refine_ovp_voltage"],
     )
 
     # This way it can't be changed back to True automatically
@@ -243,44 +255,145 @@ def sweep(
 ):
     p()  # Refresh Prefs
 
+    start = p.refs["starting_current"]
+    limit = p.refs["sweep_limit"]
+
+    # Narrow the sweep down to where previous sweeps say the knee should be
+    prediction = None
+    if p.refs["sweep_warm_start"]:
+        prediction = setup.sweep_history.predict(
+            auto_er.charge_passed, magnitude, time
+        )
+
+    if prediction is not None:
+        knee, half_width = prediction
+
+        # Always leave room for the Savitzky-Golay window on either side
+        half_width = max(half_width, 4 * magnitude)
+
+        # The window is a whole number of the full sweep's steps wide and
+        # starts on one of them (starting_current + k * magnitude), so the
+        # points stay evenly spaced like the derivatives assume. It's kept
+        # inside the full sweep's range, sliding back in if the prediction is
+        # near either end
+        full_steps = math.floor((limit - start) / magnitude + 1e-6)
+        steps = min(math.ceil(2 * half_width / magnitude), full_steps)
+        k = round((knee - half_width - start) / magnitude)
+        k = min(max(k, 0), full_steps - steps)
+
+        start = round(start + k * magnitude, 9)
+        limit = round(start + steps * magnitude, 9)
+
+        print(
+            "\tPredicted knee at " + str(round(knee, 2)) + "A, narrowing sweep"
+        )
+
+    sweep_between(start, limit, magnitude, time)
+
+    # If the narrowed sweep didn't find the knee comfortably inside its
+    # window, fall back to a full sweep (pointless if the power supply's
+    # protection stopped it)
+    if not auto_er.sweep_tripped and (start, limit) != (
+        p.refs["starting_current"],
+        p.refs["sweep_limit"],
+    ):
+        edge = 2 * magnitude
+        if (
+            not sweep_found_knee()
+            or auto_er.max_sec_div <= start + edge
+            or auto_er.max_sec_div >= limit - edge
+        ):
+            print("\tKnee not found where predicted, sweeping full range")
+
+            start = p.refs["starting_current"]
+            limit = p.refs["sweep_limit"]
+            sweep_between(start, limit, magnitude, time)
+
+    # Index sweeps with a knee so the next one can be narrowed down
+    if sweep_found_knee():
+        setup.sweep_history.add(
+            knee=auto_er.max_sec_div,
+            curvature=auto_er.max_sec_div_y,
+            charge=auto_er.charge_passed,
+            start=start,
+            limit=limit,
+            magnitude=magnitude,
+            step_duration=time,
+        )
+
+
+# Whether the last sweep's current steps went up monotonically and it found a
+# knee. Unlike sweep_valid(), the knee's current isn't compared to the maximum
+# first derivative (in V/A), which would reject most real sweeps
+def sweep_found_knee():
+    return (
+        not auto_er.sweep_tripped and auto_er.min_dx > 0 and not sweep_linear()
+    )
+
+
+# Sweeps from start to limit (in amps) with the provided step magnitude and
+# duration. All other parameters are pulled from prefs.yaml
+def sweep_between(start, limit, magnitude, time):
     # "STARTING SWEEP FROM [X] TO [X]"
     print(
         prtclrs.blue
         + prtclrs.bold
         + "STARTING SWEEP FROM "
-        + str(round(p.refs["starting_current"], 2))
+        + str(round(start, 2))
         + " TO "
-        + str(round(p.refs["sweep_limit"], 2))
+        + str(round(limit, 2))
         + prtclrs.reset
     )
 
-    # time_estimate = steps * step duration
-    # steps = 1 + ceil(current range / step magnitude)
-    current_range = p.refs["sweep_limit"] - p.refs["starting_current"]
-    num_steps = 1 + math.ceil(current_range / magnitude)
-    time_estimate = num_steps * time
+    # Adaptive sweeps take anywhere up to sweep_max_samples at each step, so
+    # estimate the worst case
+    if p.refs["sweep_adaptive"]:
+        samples_per_step = p.refs["sweep_max_samples"]
+    else:
+        samples_per_step = p.refs["sweep_sample_amount"]
 
-    # Add time for measurement to help with the time_estimate's accuracy
-    time_estimate += (
-        num_steps * p.refs["sweep_sample_amount"] * p.refs["sample_latency"]
+    time_estimate = auto_er.sweep_time_estimate(
+        step_duration=time,
+        step_magnitude=magnitude,
+        sweep_limit=limit,
+        starting_current=start,
+        sweep_sample_amount=samples_per_step,
+        sample_latency=p.refs["sample_latency"],
     )
 
     completion_time = dt.datetime.now() + dt.timedelta(seconds=time_estimate)
 
     # "ETA: [X]"
     print("\tETA:\t" + completion_time.strftime("%I:%M:%S %p"))
+    dashboard.set_status(
+        "Sweeping from "
+        + str(round(start, 2))
+        + "A to "
+        + str(round(limit, 2))
+        + "A",
+        completion_time.timestamp(),
+    )
 
     auto_er.max_sec_div = auto_er.sweep(
         psu=setup.psu,
         step_duration=time,
         step_magnitude=magnitude,
-        sweep_limit=p.refs["sweep_limit"],
+        sweep_limit=limit,
         csv_path=p.refs["sweeps_csv_path"],
         smoothed=p.refs["smooth_sec_div"],
-        starting_current=p.refs["starting_current"],
+        starting_current=start,
         sweep_sample_amount=p.refs["sweep_sample_amount"],
+        adaptive=p.refs["sweep_adaptive"],
+        target_stderr=p.refs["sweep_target_stderr"],
+        min_samples=p.refs["sweep_min_samples"],
+        max_samples=p.refs["sweep_max_samples"],
     )
 
+    # auto_er.sweep() has already said why if the power supply's protection
+    # stopped the sweep
+    if auto_er.sweep_tripped:
+        return
+
     # Short print statement about sweep results
     if sweep_valid():
         if sweep_linear():
@@ -323,6 +436,7 @@ def back_emf(
 
     # "ETA: [X]"
     print("\tETA:\t" + completion_time.strftime("%I:%M:%S %p"))
+    dashboard.set_status("Recording back emf", completion_time.timestamp())
 
     auto_er.back_emf_at_time = auto_er.back_emf(
         psu=setup.psu,
@@ -10,11 +10,25 @@ Keysight power supply.
 
 # Needed to use the TCP socket available on our power supply
 import socket
-import csv
+import storage
+import dashboard
+import shm_ring
 import datetime as dt
 
 
 class Power_supply:
+    # Bits of the questionable status register (STAT:QUES:COND?) that mean
+    # the power supply's own protection has latched the output off
+    PROTECTION_BITS = {
+        1: "over-voltage",
+        2: "over-current",
+        16: "over-temperature",
+    }
+
+    # The power supply rejects a voltage setting above this fraction of its
+    # over-voltage protection level, and vice versa
+    OVP_MARGIN = 0.95
+
     def __init__(
         self,
         ip="10.2.115.225",
@@ -23,20 +37,59 @@ class Power_supply:
         buffer=1024,
         max_psu_voltage=12.5,
         full_csv_path="full_data.csv",
+        ovp_voltage=None,
+        ocp=False,
     ):
 
         self.full_csv_path = full_csv_path
         self.buffer = buffer
+        self.status = 0  # Questionable status register from the last measure
         self.socket = socket.socket()
         self.socket.settimeout(timeout)
         self.socket.connect((ip, port))
 
+        # Start with an empty error queue so check_errors() only reports
+        # commands sent from here on
+        self.__sendln("*CLS")
+
+        # A protection latched during an earlier run would keep the output off
+        # for the whole of this one. The output is turned off first, since
+        # clearing the latch puts it back to how it was when it tripped
+        self.status = int(float(self.__read("STAT:QUES:COND?")))
+        if self.tripped():
+            print(
+                "\033[31m"  # Red
+                + "Clearing power supply "
+                + ", ".join(self.tripped())
+                + " protection latched before this run"
+                + "\033[0m"  # Reset
+            )
+            self.__sendln("OUTP OFF")
+            self.clear_protection()
+
+        # The over-voltage protection level in force, kept up to date by
+        # set_protection(). Without an ovp_voltage, whatever the power supply
+        # is already set to is what refine() restores afterwards
+        self.ovp_level = float(self.__read("VOLT:PROT?"))
+        if ovp_voltage is None:
+            ovp_voltage = self.ovp_level
+        self.ovp_voltage = ovp_voltage
+
         # The power supply operates either at the set current, or the set
         # voltage, whichever uses *less* power. By setting the voltage to the
         # maximum allowed by the power supply, we ensure that it will always be
         # operating at the specified current, as long as the corresponding
         # voltage is lower than the maximum voltage (constant current mode).
-        self.set_voltage(max_psu_voltage)
+        # The power supply also protects the cell itself at ovp_voltage
+        # instead of relying on the host sampling fast enough to notice a
+        # problem
+        self.set_limits(max_psu_voltage, ovp_voltage)
+
+        # Over-current protection trips as soon as the power supply enters
+        # constant current mode, which is how refining normally runs, so it's
+        # usually left off
+        self.__sendln("CURR:PROT:STAT " + ("ON" if ocp else "OFF"))
+        self.check_errors()
 
     # Private function, simply sends a provided command to the power supply and
     # waits until it has been processed, unless the force argument is True.
@@ -92,6 +145,78 @@ class Power_supply:
     def set_voltage(self, voltage_to_set):
         self.__sendln("VOLT " + str(voltage_to_set))
 
+    # Program the power supply's over-voltage protection level. Unlike
+    # set_voltage(), going past it latches the output off until
+    # clear_protection() is called
+    def set_protection(self, ovp_voltage):
+        self.__sendln("VOLT:PROT " + str(ovp_voltage))
+        self.ovp_level = ovp_voltage
+
+    # Set the maximum voltage and the over-voltage protection level together
+    # (the protection level is left alone if ovp_voltage is None). The power
+    # supply rejects either one if it would put the voltage above OVP_MARGIN
+    # of the protection level, so the protection goes up first and comes
+    # down last. Raises ValueError if the pair can't be set and RuntimeError
+    # if the power supply rejected anything
+    def set_limits(self, voltage, ovp_voltage=None):
+        if ovp_voltage is None:
+            ovp_voltage = self.ovp_level
+
+        if voltage > ovp_voltage * self.OVP_MARGIN:
+            raise ValueError(
+                "A maximum voltage of "
+                + str(voltage)
+                + "V needs an over-voltage protection level of at least "
+                + str(round(voltage / self.OVP_MARGIN, 2))
+                + "V, not "
+                + str(ovp_voltage)
+                + "V"
+            )
+
+        if ovp_voltage >= self.ovp_level:
+            self.set_protection(ovp_voltage)
+            self.set_voltage(voltage)
+
+        else:
+            self.set_voltage(voltage)
+            self.set_protection(ovp_voltage)
+
+        self.check_errors()
+
+    # Raises RuntimeError listing everything in the power supply's error
+    # queue (SYST:ERR?), if anything. Commands the power supply rejects are
+    # otherwise ignored without a word
+    def check_errors(self):
+        errors = []
+
+        # The queue is read until it reports '0,"No error"'. It only holds a
+        # few dozen entries, so this can't go on forever
+        while len(errors) < 32:
+            error = self.__read("SYST:ERR?")
+            if error.split(",")[0].strip() in ["0", "+0"]:
+                break
+
+            errors.append(error)
+
+        if errors:
+            raise RuntimeError(
+                "Power supply rejected a command: " + "; ".join(errors)
+            )
+
+    # Clear a latched protection trip so the output can be enabled again
+    def clear_protection(self):
+        self.__sendln("OUTP:PROT:CLE")
+        self.status = 0
+
+    # Returns a list of the protections (ex. "over-voltage") that had tripped
+    # as of the last measure(), empty if none
+    def tripped(self):
+        return [
+            name
+            for bit, name in self.PROTECTION_BITS.items()
+            if self.status & bit
+        ]
+
     # Enables the power supply output
     def enable(self):
         self.__sendln("OUTP ON")
@@ -101,30 +226,55 @@ class Power_supply:
         self.__sendln("OUTP OFF")
 
         # Add a zero to the .csv
-        with open(self.full_csv_path, "a", newline="") as csvfile:
-            csv.writer(csvfile).writerow(
-                [
-                    # Seconds since epoch
-                    dt.datetime.timestamp(dt.datetime.now()),
-                    0.0,
-                    -1,
-                ]
-            )
+        storage.writerow(
+            self.full_csv_path,
+            [
+                # Seconds since epoch
+                dt.datetime.timestamp(dt.datetime.now()),
+                0.0,
+                -1,
+                self.status,
+            ],
+            include_in_rollups=False,
+        )
 
-    # Returns a tuple of (measured current, measured voltage)
+    # Returns a tuple of (measured current, measured voltage). The status
+    # register is queried in the same exchange and kept in self.status, which
+    # is also recorded in the 4th column of the .csv
     def measure(self):
-        meas_curr = float(self.__read("MEAS:CURR?"))
-        meas_volt = float(self.__read("MEAS:VOLT?"))
-
-        with open(self.full_csv_path, "a", newline="") as csvfile:
-            csv.writer(csvfile).writerow(
-                [
-                    # Seconds since epoch
-                    dt.datetime.timestamp(dt.datetime.now()),
-                    meas_curr,
-                    meas_volt,
-                ]
-            )
+        reply = self.__read("MEAS:CURR?;:MEAS:VOLT?;:STAT:QUES:COND?")
+        meas_curr, meas_volt, status = reply.split(";")
+        meas_curr = float(meas_curr)
+        meas_volt = float(meas_volt)
+
+        previous_trips = self.tripped()
+        self.status = int(float(status))
+
+        timestamp = dt.datetime.timestamp(dt.datetime.now())
+        storage.writerow(
+            self.full_csv_path,
+            [
+                timestamp,  # Seconds since epoch
+                meas_curr,
+                meas_volt,
+                self.status,
+            ],
+            timestamp,
+        )
+
+        # Log a trip on the very sample it's first seen
+        for name in self.tripped():
+            if name not in previous_trips:
+                print(
+                    "\033[31m"  # Red
+                    + "Power supply "
+                    + name
+                    + " protection tripped!"
+                    + "\033[0m"  # Reset
+                )
+
+        dashboard.add_sample(timestamp, meas_curr, meas_volt)
+        shm_ring.publish(timestamp, meas_curr, meas_volt, self.status)
 
         return (meas_curr, meas_volt)
 
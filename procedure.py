@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" procedure.py
+
+This module contains the engine that runs a procedure written in YAML (see
+procedure.yaml). The whole procedure is checked and its schedule planned
+before anything is run. Planned and actual durations are reported as each
+step finishes and once the procedure is done.
+
+"""
+
+import datetime as dt
+import time
+
+import yaml
+
+import auto_er
+
+# Steps that do something, as opposed to steps that control the flow
+ACTIONS = ["refine", "sweep", "back_emf", "wait", "set"]
+
+
+class Procedure:
+    # path: YAML file containing the procedure
+    # actions: {"refine": f, "sweep": f, "back_emf": f}, each called with the
+    #     step's parameters as keyword arguments
+    # conditions: {"name": f}, each returning a bool
+    # values: {"name": f}, each returning a number (ex. "sweep_current")
+    # prefs: dictionary of prefs.yaml, used for defaults and planning
+    def __init__(self, path, actions, conditions, values, prefs):
+        self.actions = actions
+        self.conditions = conditions
+        self.values = values
+        self.prefs = prefs
+        self.variables = {}
+
+        # (kind, label, planned seconds, actual seconds) of finished steps
+        self.report = []
+
+        with open(path, "r") as file:
+            document = yaml.safe_load(file)
+
+        if not isinstance(document, dict) or "steps" not in document:
+            raise ValueError(path + ": expected a top level 'steps' list")
+
+        self.steps = self.__compile(document["steps"], "steps", set())
+
+    # Runs the procedure from start to finish
+    def run(self):
+        planned = sum(step["planned"] for step in self.steps)
+        print(
+            "\033[01m"  # Bold
+            + "PROCEDURE PLANNED FOR "
+            + self.__format_duration(planned)
+            + "\033[0m"  # Reset
+        )
+
+        # Say what the plan assumes, since it's neither a lower nor an upper
+        # bound once adaptive sweeps are planned for their worst case
+        assumptions = "\tAssuming each while loop runs once"
+        if self.prefs["sweep_adaptive"]:
+            assumptions += (
+                " and adaptive sweeps take "
+                + str(self.prefs["sweep_max_samples"])
+                + " samples per step"
+            )
+        print(assumptions)
+        print(
+            "\tETA:\t"
+            + (dt.datetime.now() + dt.timedelta(seconds=planned)).strftime(
+                "%I:%M:%S %p"
+            )
+        )
+
+        start_time = time.time()
+
+        try:
+            self.__run(self.steps)
+
+        finally:
+            self.__print_report(time.time() - start_time)
+
+    # Turns the YAML list of steps into a list of dictionaries with the
+    # parameters filled in, checked and planned:
+    #   {"kind": ..., "args": {...}, "label": ..., "planned": seconds, ...}
+    # defined is the set of variable names that are sure to have been set by
+    # the time these steps run. Names set by the steps are added to it
+    def __compile(self, steps, where, defined):
+        if not isinstance(steps, list):
+            raise ValueError(where + ": expected a list of steps")
+
+        compiled = []
+        for i, step in enumerate(steps):
+            here = where + "[" + str(i) + "]"
+
+            if not isinstance(step, dict) or len(step) != 1:
+                raise ValueError(
+                    here + ": expected a single 'kind: ...' entry"
+                )
+
+            kind, args = next(iter(step.items()))
+            if args is None:
+                args = {}
+
+            if kind in ACTIONS:
+                compiled.append(
+                    self.__compile_action(kind, args, here, defined)
+                )
+
+            elif kind == "for":
+                self.__expect(args, ["name", "values", "steps"], [], here)
+                body = self.__compile(
+                    args["steps"], here + ".steps", defined | {args["name"]}
+                )
+                compiled.append(
+                    {
+                        "kind": kind,
+                        "name": args["name"],
+                        "values": list(args["values"]),
+                        "steps": body,
+                        "planned": len(args["values"])
+                        * sum(s["planned"] for s in body),
+                    }
+                )
+
+            elif kind == "while":
+                self.__expect(args, ["condition", "steps"], [], here)
+                self.__check_condition(args["condition"], here)
+
+                # The body may not run at all, so whatever it sets can't be
+                # counted on afterwards
+                body = self.__compile(
+                    args["steps"], here + ".steps", set(defined)
+                )
+
+                # The number of iterations isn't known ahead of time, so plan
+                # for one of them
+                compiled.append(
+                    {
+                        "kind": kind,
+                        "condition": args["condition"],
+                        "steps": body,
+                        "planned": sum(s["planned"] for s in body),
+                    }
+                )
+
+            elif kind == "if":
+                self.__expect(args, ["condition", "then"], ["else"], here)
+                self.__check_condition(args["condition"], here)
+
+                # Only names set by both branches are set afterwards
+                then_defined = set(defined)
+                else_defined = set(defined)
+                then = self.__compile(
+                    args["then"], here + ".then", then_defined
+                )
+                otherwise = self.__compile(
+                    args.get("else", []), here + ".else", else_defined
+                )
+                defined |= then_defined & else_defined
+                compiled.append(
+                    {
+                        "kind": kind,
+                        "condition": args["condition"],
+                        "then": then,
+                        "else": otherwise,
+                        "planned": max(
+                            sum(s["planned"] for s in then),
+                            sum(s["planned"] for s in otherwise),
+                        ),
+                    }
+                )
+
+            else:
+                raise ValueError(here + ": unknown step '" + str(kind) + "'")
+
+        return compiled
+
+    def __compile_action(self, kind, args, where, defined):
+        prefs = self.prefs
+
+        if kind == "wait":
+            # "wait: 30" is short for "wait: {seconds: 30}"
+            if not isinstance(args, dict):
+                args = {"seconds": args}
+
+            self.__expect(args, ["seconds"], ["message"], where)
+            planned = float(args["seconds"])
+            label = "wait " + str(args["seconds"]) + "s"
+
+        elif kind == "set":
+            self.__expect(args, [], list(args) if args else [], where)
+            for value in args.values():
+                self.__check_value(value, where, defined)
+            defined.update(args)
+
+            planned = 0.0
+            label = "set " + ", ".join(args)
+
+        elif kind == "refine":
+            self.__expect(args, ["current"], ["time"], where)
+            self.__check_value(args["current"], where, defined)
+            args.setdefault("time", prefs["refining_period"])
+
+            planned = float(args["time"]) * 60
+            label = "refine at " + str(args["current"])
+
+        elif kind == "sweep":
+            self.__expect(args, [], ["magnitude", "time"], where)
+            args.setdefault("magnitude", prefs["step_magnitude"])
+            args.setdefault("time", prefs["step_duration"])
+
+            # Adaptive sweeps take anywhere up to sweep_max_samples at each
+            # step, so plan for the worst case
+            if prefs["sweep_adaptive"]:
+                samples_per_step = prefs["sweep_max_samples"]
+            else:
+                samples_per_step = prefs["sweep_sample_amount"]
+
+            planned = auto_er.sweep_time_estimate(
+                step_duration=args["time"],
+                step_magnitude=args["magnitude"],
+                sweep_limit=prefs["sweep_limit"],
+                starting_current=prefs["starting_current"],
+                sweep_sample_amount=samples_per_step,
+                sample_latency=prefs["sample_latency"],
+            )
+            label = "sweep " + str(args["magnitude"]) + "A steps"
+
+        elif kind == "back_emf":
+            self.__expect(args, [], ["print_time", "time"], where)
+            args.setdefault("print_time", prefs["back_emf_print_time"])
+            args.setdefault("time", prefs["back_emf_period"])
+
+            planned = float(args["time"])
+            label = "back emf"
+
+        return {"kind": kind, "args": args, "label": label, "planned": planned}
+
+    def __expect(self, args, required, optional, where):
+        if not isinstance(args, dict):
+            raise ValueError(where + ": expected a mapping of parameters")
+
+        for key in required:
+            if key not in args:
+                raise ValueError(where + ": missing '" + key + "'")
+
+        for key in args:
+            if key not in required and key not in optional:
+                raise ValueError(where + ": unexpected '" + str(key) + "'")
+
+    # Conditions are a name from self.conditions, optionally starting with
+    # "not ", or {"all": [...]} / {"any": [...]} of conditions
+    def __check_condition(self, condition, where):
+        if isinstance(condition, dict) and len(condition) == 1:
+            key, conditions = next(iter(condition.items()))
+            if key in ["all", "any"] and isinstance(conditions, list):
+                for c in conditions:
+                    self.__check_condition(c, where)
+                return
+
+        elif isinstance(condition, str):
+            name = condition[4:] if condition.startswith("not ") else condition
+            if name in self.conditions:
+                return
+
+        raise ValueError(where + ": unknown condition " + repr(condition))
+
+    # Values are numbers, names (variables in defined, set by an earlier
+    # "set"/"for", or something in self.values) or
+    # {"multiply": [value, value]}
+    def __check_value(self, value, where, defined):
+        if isinstance(value, dict):
+            if list(value) != ["multiply"] or len(value["multiply"]) != 2:
+                raise ValueError(where + ": unknown value " + repr(value))
+
+            for v in value["multiply"]:
+                self.__check_value(v, where, defined)
+
+        elif isinstance(value, str):
+            if value not in defined and value not in self.values:
+                raise ValueError(
+                    where + ": '" + value + "' is not set before this step"
+                )
+
+        elif not isinstance(value, (int, float)):
+            raise ValueError(where + ": unknown value " + repr(value))
+
+    def __condition(self, condition):
+        if isinstance(condition, dict):
+            key, conditions = next(iter(condition.items()))
+            results = (self.__condition(c) for c in conditions)
+            return all(results) if key == "all" else any(results)
+
+        if condition.startswith("not "):
+            return not self.conditions[condition[4:]]()
+
+        return self.conditions[condition]()
+
+    def __value(self, value):
+        if isinstance(value, dict):
+            a, b = value["multiply"]
+            return self.__value(a) * self.__value(b)
+
+        if isinstance(value, str):
+            if value in self.variables:
+                return self.variables[value]
+
+            if value in self.values:
+                return self.values[value]()
+
+            raise ValueError("'" + value + "' has not been set")
+
+        return value
+
+    def __run(self, steps):
+        for step in steps:
+            kind = step["kind"]
+
+            if kind == "for":
+                for value in step["values"]:
+                    self.variables[step["name"]] = value
+                    self.__run(step["steps"])
+
+            elif kind == "while":
+                while self.__condition(step["condition"]):
+                    self.__run(step["steps"])
+
+            elif kind == "if":
+                if self.__condition(step["condition"]):
+                    self.__run(step["then"])
+                else:
+                    self.__run(step["else"])
+
+            else:
+                self.__run_action(step)
+
+    def __run_action(self, step):
+        kind = step["kind"]
+        args = step["args"]
+        start_time = time.time()
+
+        if kind == "set":
+            for name, value in args.items():
+                self.variables[name] = self.__value(value)
+            return
+
+        if kind == "wait":
+            if "message" in args:
+                print(args["message"])
+
+            time.sleep(float(args["seconds"]))
+
+        elif kind == "refine":
+            self.actions["refine"](
+                current=self.__value(args["current"]), time=args["time"]
+            )
+
+        else:
+            self.actions[kind](**args)
+
+        actual = time.time() - start_time
+        self.report.append((kind, step["label"], step["planned"], actual))
+
+        print(
+            "\tPlanned "
+            + self.__format_duration(step["planned"])
+            + ", took "
+            + self.__format_duration(actual)
+        )
+
+    def __print_report(self, total):
+        planned = sum(entry[2] for entry in self.report)
+
+        print("\033[01m" + "PROCEDURE REPORT" + "\033[0m")  # Bold
+        row = "\t{:<24}{:>8}{:>12}{:>12}"
+        print(row.format("Step", "Count", "Planned", "Actual"))
+
+        totals = {}
+        for kind, _, step_planned, actual in self.report:
+            count, p, a = totals.get(kind, (0, 0.0, 0.0))
+            totals[kind] = (count + 1, p + step_planned, a + actual)
+
+        for kind, (count, p, a) in totals.items():
+            print(
+                row.format(
+                    kind,
+                    count,
+                    self.__format_duration(p),
+                    self.__format_duration(a),
+                )
+            )
+
+        print(
+            row.format(
+                "total",
+                len(self.report),
+                self.__format_duration(planned),
+                self.__format_duration(total),
+            )
+        )
+
+    def __format_duration(self, seconds):
+        return str(dt.timedelta(seconds=round(seconds)))
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" shm_ring.py
+
+This module publishes every measurement into a ring buffer in shared memory,
+so other processes on the same computer (plotting scripts, notebooks, etc.)
+can follow the run without polling the .csv files. There is a single writer
+(the acquisition loop) that never waits on anybody, and any number of
+readers. Readers map the buffer directly and use the sequence numbers to
+notice samples that were overwritten before they got to them.
+
+To follow a run from another terminal:
+
+    $ python ./shm_ring.py [name]
+
+"""
+
+import atexit
+import os
+import sys
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+# Identifies the buffer as one of ours
+MAGIC = int.from_bytes(b"AUTOER02", "little")
+
+# Header: magic, capacity (records), number of records ever written and the
+# writer's process ID
+HEADER = np.dtype(
+    [
+        ("magic", "<i8"),
+        ("capacity", "<i8"),
+        ("written", "<i8"),
+        ("pid", "<i8"),
+    ]
+)
+
+# One record per measurement. seq is -1 while a record is being written
+RECORD = np.dtype(
+    [
+        ("seq", "<i8"),
+        ("time", "<f8"),  # Seconds since epoch
+        ("current", "<f8"),
+        ("voltage", "<f8"),
+        ("status", "<i8"),  # Power supply questionable status register
+    ]
+)
+
+# The writer used by publish(), created by start()
+_writer = None
+
+
+# Creates the shared memory ring so publish() starts writing to it
+def start(name="auto_er", capacity=65536):
+    global _writer
+
+    if _writer is None:
+        _writer = Ring_writer(name, capacity)
+        atexit.register(_writer.close)
+
+        print("\tShared memory ring:\t" + name)
+
+
+# Called for every measurement. Does nothing until start() has been called
+def publish(timestamp, current, voltage, status=0):
+    if _writer is not None:
+        _writer.publish(timestamp, current, voltage, status)
+
+
+# Returns numpy views of (header, records) over a shared memory buffer
+def __map__(shm, capacity):
+    header = np.ndarray((), dtype=HEADER, buffer=shm.buf)
+    records = np.ndarray(
+        (capacity,), dtype=RECORD, buffer=shm.buf, offset=HEADER.itemsize
+    )
+    return header, records
+
+
+# Removes an existing buffer of the given name if it's one of ours whose writer
+# is no longer running. Raises FileExistsError otherwise
+def __remove_stale__(name):
+    existing = shared_memory.SharedMemory(name)
+
+    try:
+        ours = existing.size >= HEADER.itemsize
+        if ours:
+            header = np.ndarray((), dtype=HEADER, buffer=existing.buf)
+            ours = int(header["magic"]) == MAGIC
+            pid = int(header["pid"])
+            del header
+
+        if not ours:
+            raise FileExistsError(
+                "Shared memory "
+                + name
+                + " already exists and isn't an auto_er ring, set a"
+                + " different shm_ring_name"
+            )
+
+        if __is_running__(pid):
+            raise FileExistsError(
+                "Shared memory ring "
+                + name
+                + " is in use by another run (process "
+                + str(pid)
+                + "), set a different shm_ring_name"
+            )
+
+    # Attaching registered the buffer with this process's resource tracker,
+    # which would remove it from under its owner at exit
+    except FileExistsError:
+        if os.name == "posix":
+            resource_tracker.unregister(existing._name, "shared_memory")
+        raise
+
+    finally:
+        existing.close()
+
+    existing.unlink()
+
+
+# Whether a process with the given ID is running. Outside POSIX, shared memory
+# disappears along with the last process using it, so a buffer that still
+# exists always has a running writer
+def __is_running__(pid):
+    if os.name != "posix":
+        return True
+
+    try:
+        os.kill(pid, 0)
+
+    except ProcessLookupError:
+        return False
+
+    except PermissionError:
+        return True
+
+    return True
+
+
+class Ring_writer:
+    def __init__(self, name="auto_er", capacity=65536):
+        size = HEADER.itemsize + capacity * RECORD.itemsize
+
+        # A buffer left behind by a run that didn't exit cleanly is replaced,
+        # but one that another run is still writing to is left alone
+        try:
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+
+        except FileExistsError:
+            __remove_stale__(name)
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+
+        self.capacity = capacity
+        self.header, self.records = __map__(self.shm, capacity)
+        self.records["seq"] = -1
+        self.header["capacity"] = capacity
+        self.header["written"] = 0
+        self.header["pid"] = os.getpid()
+        self.header["magic"] = MAGIC
+
+        self.__written = 0
+
+    # Writes one record. The record's seq is cleared first and set last so a
+    # reader can tell when it raced with this
+    def publish(self, timestamp, current, voltage, status=0):
+        if self.shm is None:
+            return
+
+        seq = self.__written
+        record = self.records[seq % self.capacity]
+
+        record["seq"] = -1
+        record["time"] = timestamp
+        record["current"] = current
+        record["voltage"] = voltage
+        record["status"] = status
+        record["seq"] = seq
+
+        self.__written = seq + 1
+        self.header["written"] = self.__written
+
+    # Unmaps and removes the buffer. Readers that are still attached keep
+    # their mapping until they close it
+    def close(self):
+        if self.shm is None:
+            return
+
+        del self.header, self.records
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+
+
+class Ring_reader:
+    # By default only samples published after attaching are read. With
+    # from_start, everything still in the buffer is read first
+    def __init__(self, name="auto_er", from_start=False):
+        self.shm = shared_memory.SharedMemory(name)
+
+        # Only the writer should remove the buffer, but on POSIX Python
+        # registers every attached process with its resource tracker, which
+        # removes it at exit
+        if os.name == "posix" and (
+            _writer is None or _writer.shm is None or _writer.shm.name != name
+        ):
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+
+        header = np.ndarray((), dtype=HEADER, buffer=self.shm.buf)
+        if int(header["magic"]) != MAGIC:
+            raise ValueError(name + " is not an auto_er shared memory ring")
+
+        self.capacity = int(header["capacity"])
+        self.header, self.records = __map__(self.shm, self.capacity)
+
+        self.missed = 0  # Samples overwritten before they could be read
+        self.next_seq = 0 if from_start else int(self.header["written"])
+        self.next_seq = max(self.next_seq, self.written() - self.capacity)
+
+    # Number of samples the writer has published so far
+    def written(self):
+        return int(self.header["written"])
+
+    # The records, mapped straight onto shared memory (no copy). A record may
+    # change at any moment, so check its seq before and after using it
+    def view(self):
+        return self.records
+
+    # Returns a structured array (seq, time, current, voltage, status) of the
+    # samples published since the last call, oldest first. Samples that were
+    # overwritten before they could be read are skipped and counted in
+    # self.missed
+    def read_new(self):
+        written = self.written()
+        start = max(self.next_seq, written - self.capacity)
+        self.missed += start - self.next_seq
+
+        expected = np.arange(start, written, dtype="<i8")
+        slots = expected % self.capacity
+
+        # Copy the records, then read their seq again. A record is only kept
+        # if its seq was what we expected both times, otherwise the writer got
+        # to it first
+        samples = self.records[slots]
+        valid = (samples["seq"] == expected) & (
+            self.records["seq"][slots] == expected
+        )
+
+        self.missed += int(len(valid) - np.count_nonzero(valid))
+        self.next_seq = written
+
+        return samples[valid]
+
+    def close(self):
+        if self.shm is not None:
+            del self.header, self.records
+            self.shm.close()
+            self.shm = None
+
+
+# Follows a run from another process, printing each new sample
+if __name__ == "__main__":
+    reader = Ring_reader(sys.argv[1] if len(sys.argv) > 1 else "auto_er")
+
+    try:
+        while True:
+            for sample in reader.read_new():
+                print(
+                    str(sample["time"])
+                    + "\t"
+                    + str(sample["current"])
+                    + "A\t"
+                    + str(sample["voltage"])
+                    + "V\t"
+                    + str(sample["status"])
+                )
+
+            time.sleep(0.1)
+
+    except KeyboardInterrupt:
+        print("\nMissed " + str(reader.missed) + " samples")
+        reader.close()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" storage.py
+
+This module contains the storage stage for the data .csv files. Registered
+files are rotated by size or age, closed segments are compressed in a
+background thread and downsampled min/mean/max rollups are kept alongside
+them so a whole run can be looked at without decompressing anything.
+
+"""
+
+import atexit
+import csv
+import datetime as dt
+import gzip
+import lzma
+import os
+import queue
+import shutil
+import threading
+import time
+
+# Rollup file suffix and bucket width, in seconds
+ROLLUP_PERIODS = {"1s": 1, "1min": 60, "10min": 600}
+
+# Compression method and the extension added to a compressed segment
+COMPRESSORS = {"gzip": (gzip.open, ".gz"), "lzma": (lzma.open, ".xz")}
+
+# Every registered Rotating_csv, keyed by the path it writes to
+archives = {}
+
+# Closed segments waiting to be compressed by the background worker
+_compression_queue = queue.Queue()
+_compression_thread = None
+
+
+# Appends a row to the .csv at the given path. If the path has been registered
+# with open_archive(), the row goes through its Rotating_csv, otherwise the
+# file is simply appended to. Placeholder rows (ex. the zeroes written while
+# the power supply is off) should pass include_in_rollups=False
+def writerow(path, row, timestamp=None, include_in_rollups=True):
+    if path in archives:
+        archives[path].writerow(row, timestamp, include_in_rollups)
+        return
+
+    with open(path, "a", newline="") as csvfile:
+        csv.writer(csvfile).writerow(row)
+
+
+# Registers the .csv at the given path so writerow() rotates, compresses and
+# rolls it up. Returns the Rotating_csv in case the caller needs it directly
+def open_archive(path, **kwargs):
+    if path not in archives:
+        archives[path] = Rotating_csv(path, **kwargs)
+
+    return archives[path]
+
+
+# Closes every registered file and waits for any pending compression to finish
+def close_all():
+    for archive in archives.values():
+        archive.close()
+
+    _compression_queue.join()
+
+
+atexit.register(close_all)
+
+
+# Hands a closed segment to the background worker, starting it if needed
+def _queue_compression(path, compression):
+    global _compression_thread
+
+    if _compression_thread is None or not _compression_thread.is_alive():
+        _compression_thread = threading.Thread(
+            target=_compression_worker, name="storage-compression", daemon=True
+        )
+        _compression_thread.start()
+
+    _compression_queue.put((path, compression))
+
+
+# Runs forever in the background, compressing segments as they are queued
+def _compression_worker():
+    while True:
+        path, compression = _compression_queue.get()
+
+        try:
+            _compress(path, compression)
+
+        except OSError as error:
+            print(
+                "\033[31m"  # Red
+                + "Could not compress "
+                + path
+                + ":\t"
+                + str(error)
+                + "\033[0m"  # Reset
+            )
+
+        finally:
+            _compression_queue.task_done()
+
+
+# Compresses a segment next to itself and removes the original. The output is
+# written under a temporary name first so a half-written file is never left
+# looking complete
+def _compress(path, compression):
+    opener, extension = COMPRESSORS[compression]
+    temp_path = path + extension + ".part"
+
+    with open(path, "rb") as source, opener(temp_path, "wb") as destination:
+        shutil.copyfileobj(source, destination)
+
+    os.replace(temp_path, path + extension)
+    os.remove(path)
+
+
+# A .csv that is rotated into timestamped segments once it gets too big or too
+# old. The active segment always lives at the original path so anything
+# tailing it keeps working
+class Rotating_csv:
+    def __init__(
+        self,
+        path,
+        max_bytes=50_000_000,
+        max_age=3600,
+        compression="gzip",
+        rollups=True,
+        rollup_columns=(1, 2),
+    ):
+        if compression not in COMPRESSORS and compression != "none":
+            raise ValueError("Unknown compression: " + str(compression))
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.compression = compression
+        self.rollup_columns = rollup_columns
+
+        self.__file = None
+        self.__writer = None
+        self.__segment_bytes = 0
+        self.__segment_start = 0.0
+
+        root, extension = os.path.splitext(path)
+        self.rollups = []
+        if rollups:
+            for suffix, period in ROLLUP_PERIODS.items():
+                self.rollups.append(
+                    Rollup(root + "_" + suffix + extension, period)
+                )
+
+        # Anything left over from a previous run becomes its own segment, so
+        # every run starts with a fresh file
+        self.__rotate_file()
+        self.__open()
+
+    # Writes a row to the active segment, rotating first if it's due, and adds
+    # its rollup_columns (current and voltage by default) to the rollups
+    # unless include_in_rollups is False
+    def writerow(self, row, timestamp=None, include_in_rollups=True):
+        if timestamp is None:
+            timestamp = time.time()
+
+        if self.__file is None:
+            self.__open()
+
+        elif (
+            self.__segment_bytes >= self.max_bytes
+            or timestamp - self.__segment_start >= self.max_age
+        ):
+            self.rotate()
+
+        # Flushed every row so the active segment can still be tailed
+        self.__segment_bytes += self.__writer.writerow(row)
+        self.__file.flush()
+
+        if self.rollups and include_in_rollups:
+            try:
+                values = [float(row[i]) for i in self.rollup_columns]
+
+            except (IndexError, TypeError, ValueError):
+                return
+
+            for rollup in self.rollups:
+                rollup.add(timestamp, values)
+
+    # Closes the active segment, queues it for compression and opens a new one
+    def rotate(self):
+        self.__close_file()
+        self.__rotate_file()
+        self.__open()
+
+    def flush(self):
+        if self.__file is not None:
+            self.__file.flush()
+
+        for rollup in self.rollups:
+            rollup.flush()
+
+    # Closes the active segment (it is not rotated, so the next run picks it
+    # up) and writes out the partially filled rollup buckets
+    def close(self):
+        self.__close_file()
+
+        for rollup in self.rollups:
+            rollup.close()
+
+    def __open(self):
+        self.__file = open(self.path, "a", newline="")
+        self.__writer = csv.writer(self.__file)
+        self.__segment_bytes = self.__file.tell()
+        self.__segment_start = time.time()
+
+    def __close_file(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+            self.__writer = None
+
+    # Moves a non-empty file at self.path to "<name>.<YYYYmmdd-HHMMSS>.csv",
+    # named after when it was last written to, and queues it for compression
+    def __rotate_file(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return
+
+        root, extension = os.path.splitext(self.path)
+        stamp = dt.datetime.fromtimestamp(
+            os.path.getmtime(self.path)
+        ).strftime("%Y%m%d-%H%M%S")
+
+        segment_path = root + "." + stamp + extension
+        counter = 1
+        while os.path.exists(segment_path) or any(
+            os.path.exists(segment_path + ext)
+            for _, ext in COMPRESSORS.values()
+        ):
+            segment_path = root + "." + stamp + "-" + str(counter) + extension
+            counter += 1
+
+        os.replace(self.path, segment_path)
+
+        if self.compression != "none":
+            _queue_compression(segment_path, self.compression)
+
+
+# Downsamples rows into fixed-width time buckets, writing one row per bucket:
+# +--------------+-------+-------+--------+-------+-------+--------+----
+# | bucket_start | count | min_0 | mean_0 | max_0 | min_1 | mean_1 | ...
+# +--------------+-------+-------+--------+-------+-------+--------+----
+# bucket_start is in seconds since epoch
+class Rollup:
+    def __init__(self, csv_path, period):
+        self.csv_path = csv_path
+        self.period = period
+
+        self.__file = None
+        self.__bucket = None
+        self.__count = 0
+        self.__mins = []
+        self.__sums = []
+        self.__maxs = []
+
+    def add(self, timestamp, values):
+        bucket = timestamp - (timestamp % self.period)
+
+        # A new bucket, or rows that suddenly have a different width, close
+        # out whatever has been collected so far
+        if bucket != self.__bucket or len(values) != len(self.__sums):
+            self.__emit()
+            self.__bucket = bucket
+            self.__count = 0
+            self.__mins = list(values)
+            self.__sums = [0.0] * len(values)
+            self.__maxs = list(values)
+
+        self.__count += 1
+        for i, value in enumerate(values):
+            self.__sums[i] += value
+            if value < self.__mins[i]:
+                self.__mins[i] = value
+            if value > self.__maxs[i]:
+                self.__maxs[i] = value
+
+    def flush(self):
+        if self.__file is not None:
+            self.__file.flush()
+
+    def close(self):
+        self.__emit()
+        self.__bucket = None
+        self.__count = 0
+
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+    def __emit(self):
+        if self.__count == 0:
+            return
+
+        row = [self.__bucket, self.__count]
+        for i in range(len(self.__sums)):
+            row += [
+                self.__mins[i],
+                self.__sums[i] / self.__count,
+                self.__maxs[i],
+            ]
+
+        if self.__file is None:
+            self.__file = open(self.csv_path, "a", newline="")
+
+        csv.writer(self.__file).writerow(row)
+        self.__file.flush()
+        self.__count = 0
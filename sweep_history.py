@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" sweep_history.py
+
+This module keeps an index of the sweeps made during a run (where the knee,
+auto_er.max_sec_div, was found, how sharp it was, when, and how much charge
+had passed by then). The knee usually moves gradually as the cell depletes,
+so the index is used to predict where the next one will be, letting the next
+sweep cover only a narrow window of current around that prediction. The step
+magnitude and duration also move the knee, so predictions only come from
+sweeps made with the same ones.
+
+"""
+
+import csv
+import time
+
+import numpy as np
+
+
+class Sweep_history:
+    # csv_path: where each indexed sweep is also recorded (or None)
+    # fit_points: how many of the latest sweeps the prediction is fit to
+    # min_half_width: smallest half width, in amps, of a predicted window
+    # width_sigmas: how many standard deviations of the fit's residuals the
+    #     window covers on either side of the prediction
+    def __init__(
+        self, csv_path=None, fit_points=4, min_half_width=6.0, width_sigmas=3.0
+    ):
+        self.csv_path = csv_path
+        self.fit_points = fit_points
+        self.min_half_width = min_half_width
+        self.width_sigmas = width_sigmas
+
+        # Each is {"time", "knee", "curvature", "charge", "start", "limit",
+        # "magnitude", "step_duration"}
+        self.sweeps = []
+
+    # Adds a valid, non-linear sweep to the index. start and limit are the
+    # current window that sweep covered, magnitude and step_duration the
+    # steps it was made with
+    def add(
+        self, knee, curvature, charge, start, limit, magnitude, step_duration
+    ):
+        entry = {
+            "time": time.time(),
+            "knee": knee,
+            "curvature": curvature,
+            "charge": charge,
+            "start": start,
+            "limit": limit,
+            "magnitude": magnitude,
+            "step_duration": step_duration,
+        }
+        self.sweeps.append(entry)
+
+        if self.csv_path is not None:
+            with open(self.csv_path, "a", newline="") as csvfile:
+                csv.writer(csvfile).writerow(
+                    [
+                        entry["time"],  # Seconds since epoch
+                        knee,  # Amps
+                        curvature,  # V/A^2
+                        charge,  # Coulombs
+                        start,  # Amps
+                        limit,  # Amps
+                        magnitude,  # Amps
+                        step_duration,  # Seconds
+                    ]
+                )
+
+    # Returns (predicted knee, half width) in amps for when the given amount
+    # of charge has passed, or None if there's nothing to go on yet. The
+    # knee is fit linearly against charge passed over the latest sweeps made
+    # with the same magnitude and step_duration
+    def predict(self, charge, magnitude, step_duration):
+        recent = [
+            s
+            for s in self.sweeps
+            if s["magnitude"] == magnitude
+            and s["step_duration"] == step_duration
+        ][-self.fit_points :]
+
+        if len(recent) == 0:
+            return None
+
+        knees = np.array([s["knee"] for s in recent])
+        charges = np.array([s["charge"] for s in recent])
+
+        # Not enough (or not different enough) sweeps for a line, so assume
+        # the knee hasn't moved and rely on the minimum window
+        if len(recent) < 3 or np.ptp(charges) == 0:
+            return float(knees[-1]), self.min_half_width * 2
+
+        slope, intercept = np.polyfit(charges, knees, 1)
+        residuals = knees - (slope * charges + intercept)
+
+        prediction = float(slope * charge + intercept)
+
+        # Standard deviation of the residuals, with 2 degrees of freedom used
+        # up by the fit
+        spread = float(np.sqrt(np.sum(residuals**2) / (len(recent) - 2)))
+        half_width = max(self.min_half_width, self.width_sigmas * spread)
+
+        return prediction, half_width